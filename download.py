@@ -6,30 +6,38 @@ Connect to twitter, check the liked tweets of the authenticated user and downloa
 """
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from modules import auth, config, directory, media, twitter
+from modules import config
 
 # Logging setup
 log = logging.getLogger()
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(module)s:%(lineno)d %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
 
+# Command line parser, built once when the module is imported
+_PARSER = argparse.ArgumentParser(description="Download media of the tweets liked by the authenticating user.")
+_PARSER.add_argument("--debug", action="store_true", help="set logging to DEBUG level")
+_PARSER.add_argument("--organize", action="store_true", help="create and manage subdirectories")
+_PARSER.add_argument("--disable-blacklist", action="store_true", help="disable filtering of blacklisted tweets")
+_PARSER.add_argument("--force", action="store_true", help="do not check if media files are already on disk")
+
+
 def parse_args():
-    parser = argparse.ArgumentParser(description="Download media of the tweets liked by the authenticating user.")
-    parser.add_argument("--debug", action="store_true", help="set logging to DEBUG level")
-    parser.add_argument("--organize", action="store_true", help="create and manage subdirectories")
-    parser.add_argument("--disable-blacklist", action="store_true", help="disable filtering of blacklisted tweets")
-    parser.add_argument("--force", action="store_true", help="do not check if media files are already on disk")
-    return parser.parse_args()
+    return _PARSER.parse_args()
 
 
 def main(args: argparse.Namespace):
+    # Imported here so that parsing the command line (ie. --help) doesn't pay for loading the heavier dependencies
+    from modules import auth, directory, media, twitter
+
     downloaded_tweets = 0
     downloaded_media_count = 0
     new_blacklisted_tweets = []
 
     # Load configuration and connect to the Twitter API
     configuration = config.get_configuration()
+    context = config.DownloadContext.from_config(configuration)
     twitter_api = auth.get_authenticated_api(configuration)
     full_tweets_list = twitter.load_liked_tweets(twitter_api)
 
@@ -40,16 +48,23 @@ def main(args: argparse.Namespace):
     else:
         tweets_list = full_tweets_list
 
-    # Process tweets one by one
-    for tweet in tweets_list:
-        log.debug(f"Processing tweet https://twitter.com/i/web/status/{tweet.id_str}")
-        tweet_media_count, media_found = media.download_media(tweet, configuration, args.force)
+    def process_tweet(tweet):
+        log.debug("Processing tweet https://twitter.com/i/web/status/%s", tweet.id_str)
+        return media.download_media(tweet, context, args.force)
+
+    # Process tweets concurrently, results are returned in the same order as tweets_list. Downloads are I/O bound, so
+    # threads are good enough.
+    media.set_max_connections(context.download_workers)
+    with ThreadPoolExecutor(max_workers=context.download_workers) as executor:
+        results = list(executor.map(process_tweet, tweets_list))
+
+    for tweet, (tweet_media_count, media_found) in zip(tweets_list, results):
         if tweet_media_count > 0:
             downloaded_tweets += 1
             downloaded_media_count += tweet_media_count
         elif not media_found and not args.disable_blacklist:
             new_blacklisted_tweets.append(tweet.id_str)
-            log.debug(f"Blacklisted tweet ID {tweet.id_str}")
+            log.debug("Blacklisted tweet ID %s", tweet.id_str)
 
     log.info(f"Downloaded {downloaded_media_count} media files from {downloaded_tweets} of {len(tweets_list)} tweets.")
 
@@ -59,7 +74,7 @@ def main(args: argparse.Namespace):
 
     # Move media to subdirectories if needed
     if args.organize:
-        directory.organize_media(configuration)
+        directory.organize_media(context)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 from configparser import ConfigParser
+from functools import lru_cache
+from typing import Tuple
 
 import tweepy  # type: ignore
 
@@ -7,12 +9,25 @@ from modules.config import get_auth_pairs
 
 def get_authenticated_api(configuration: ConfigParser) -> tweepy.API:
     """
-    Load Twitter credentials and initialize the tweepy API.
+    Load Twitter credentials and initialize the tweepy API. The API object is built once per process for the same
+    credentials. No request is made here: the credentials are only used to sign the first actual API request.
 
     :param configuration: initialized ConfigParser object.
     :return: authenticated tweepy API object.
     """
     auth_pair, token_pair = get_auth_pairs(configuration)
+    return _create_api(auth_pair, token_pair)
+
+
+@lru_cache(maxsize=1)
+def _create_api(auth_pair: Tuple[str, str], token_pair: Tuple[str, str]) -> tweepy.API:
+    """
+    Initialize the tweepy API with the given credentials.
+
+    :param auth_pair: consumer key and secret
+    :param token_pair: access token and secret
+    :return: authenticated tweepy API object.
+    """
     auth = tweepy.OAuth1UserHandler(*auth_pair)
     auth.set_access_token(*token_pair)
     return tweepy.API(auth)
@@ -3,9 +3,12 @@ Handle configuration file.
 """
 import configparser
 import logging
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import Dict, Tuple
 
 DEFAULT_CONFIG_FILE = "config.ini"
+DEFAULT_DOWNLOAD_WORKERS = 16
 REQUIRED_CONFIG_STRUCT = {
     "auth": ["consumer_key", "consumer_secret"],
     "token": ["access_token", "access_token_secret"],
@@ -24,6 +27,29 @@ class ConfigException(Exception):
     ...
 
 
+@dataclass(frozen=True, slots=True)
+class DownloadContext:
+    """Configuration values needed to download and organize media, read once from the configuration file."""
+
+    download_directory: str
+    min_media_for_directory: int
+    download_workers: int
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser) -> "DownloadContext":
+        """
+        Build the download context from configuration.
+
+        :param config: initialized ConfigParser object
+        :return: DownloadContext object
+        """
+        return cls(
+            download_directory=get_download_directory(config),
+            min_media_for_directory=get_min_media_for_directory(config),
+            download_workers=get_download_workers(config),
+        )
+
+
 def _load_configuration(config_file: str) -> configparser.ConfigParser:
     """
     Read the configuration file and return an initialized ConfigParser object.
@@ -40,22 +66,32 @@ def _load_configuration(config_file: str) -> configparser.ConfigParser:
 
 def _validate_configuration(config: configparser.ConfigParser):
     """
-    Assert the configuration file contains REQUIRED_CONFIG_STRUCT.
+    Assert the configuration file contains REQUIRED_CONFIG_STRUCT, and that the optional values are valid.
 
     :param config: initialized ConfigParser object.
     :raise ConfigException: on validation failure.
     """
-    for section in REQUIRED_CONFIG_STRUCT:
+    for section, keys in REQUIRED_CONFIG_STRUCT.items():
         if section not in config:
             log.error(f"Missing required section '{section}' in configuration file.")
             raise ConfigException(f"Section '{section}' missing")
 
-    for section in REQUIRED_CONFIG_STRUCT:
-        for key in REQUIRED_CONFIG_STRUCT[section]:
-            if not config[section].get(key):
+        section_proxy = config[section]
+        for key in keys:
+            if not section_proxy.get(key):
                 log.error(f"Missing required key '{key}' in section '{section}' in configuration file.")
                 raise ConfigException(f"Key '{key}' missing")
 
+    # Checked here rather than when the thread pools are created, in the middle of a run
+    try:
+        download_workers = get_download_workers(config)
+    except ValueError:
+        download_workers = 0
+    if download_workers < 1:
+        workers_value = config.get("download", "workers")
+        log.error(f"Key 'workers' in section 'download' must be a positive integer, found '{workers_value}'.")
+        raise ConfigException("Key 'workers' invalid")
+
 
 def get_auth_pairs(config: configparser.ConfigParser) -> Tuple[Tuple[str, str], Tuple[str, str]]:
     """
@@ -80,9 +116,11 @@ def get_blacklist_file(config: configparser.ConfigParser) -> str:
     return config["file"]["blacklist_file"]
 
 
+@lru_cache(maxsize=1)
 def get_configuration(from_file: str = DEFAULT_CONFIG_FILE) -> configparser.ConfigParser:
     """
-    Return configuration loaded from target file.
+    Return configuration loaded from target file. The file is only loaded and validated once, the same object is
+    returned by later calls until invalidate_configuration() is called.
 
     :param from_file: configuration file to read
     :return: ConfigParser object
@@ -100,6 +138,16 @@ def get_download_directory(config: configparser.ConfigParser) -> str:
     return config["file"]["download_directory"]
 
 
+def get_download_workers(config: configparser.ConfigParser) -> int:
+    """
+    Retrieve the maximum number of concurrent downloads from config, DEFAULT_DOWNLOAD_WORKERS if not specified.
+
+    :param config: initialized ConfigParser object
+    :return: user-specified number
+    """
+    return config.getint("download", "workers", fallback=DEFAULT_DOWNLOAD_WORKERS)
+
+
 def get_min_media_for_directory(config: configparser.ConfigParser) -> int:
     """
     Retrieve the minimum amount of media files downloaded from a certain account before creating a directory
@@ -144,3 +192,10 @@ def get_tagmap_file(config: configparser.ConfigParser) -> str:
     :return: path to blacklist file
     """
     return config["file"]["tags_file"]
+
+
+def invalidate_configuration():
+    """
+    Discard the configuration cached by get_configuration(), so that the configuration file is loaded again.
+    """
+    get_configuration.cache_clear()
@@ -1,136 +1,163 @@
-import configparser
 import logging
 import os
-from collections import defaultdict
-from typing import Dict, List
+import shutil
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
 
-from .config import get_download_directory, get_min_media_for_directory
-from .utils import groupdict_from_filename
+from .config import DownloadContext
+from .utils import groupdict_from_filename, isdir_cached
+
+# Maximum number of files moved at the same time
+MAX_MOVE_WORKERS = 8
 
 log = logging.getLogger()
 
 
-def organize_media(configuration: configparser.ConfigParser):
+def organize_media(context: DownloadContext):
     """
     Module's entry point. Scan the download directory and move media files to their own subdirectory (organized by
     author.)
 
-    :param configuration: initialized ConfigParser object
+    :param context: DownloadContext built from configuration
     """
-    # Scan download directory and build a dictionary counting how many media files have been found for the same author
-    download_directory = get_download_directory(configuration)
+    # Scan download directory once, counting how many media files have been found for the same author and collecting
+    # the existing subdirectories
+    download_directory = context.download_directory
     log.info(f"Organizing directory {download_directory}")
-    media_count = _scan_directory(download_directory)
+    media_count, subdirectories, files_by_account = _scan_directory(download_directory)
 
     # Create subdirectories for authors with enough media files
-    threshold = get_min_media_for_directory(configuration)
-    _create_new_directories(media_count, threshold, download_directory)
+    new_directories = _create_new_directories(
+        media_count, context.min_media_for_directory, download_directory, subdirectories
+    )
+    isdir_cached.cache_clear()
 
-    # Find all existing subdirectories and move matching files
-    available_directories = _get_all_subdirectories(download_directory)
-    _move_files_to_subdirectory(download_directory, available_directories)
+    # Move files into both the existing and the newly created subdirectories
+    _move_files_to_subdirectory(download_directory, subdirectories | new_directories, files_by_account)
 
 
-def _create_new_directories(media_count: Dict[str, int], threshold: int, download_directory: str):
+def _create_new_directories(
+    media_count: Dict[str, int], threshold: int, download_directory: str, existing_directories: Set[str]
+) -> Set[str]:
     """
     Create new directories if an account has media files in the download directory greater than or equal the threshold.
 
     :param media_count: dictionary of account and media files count
     :param threshold: minimum number of media files in the download directory to create a subdirectory for the account
     :param download_directory: media files download directory
+    :param existing_directories: set of subdirectories already found in download_directory
+    :return: set of the subdirectory names that have been created
     """
+    new_directories = set()
     for account, media_files in media_count.items():
-        if media_files >= threshold:
+        if account in existing_directories:
+            log.debug(f"Directory {account} already exists")
+        elif media_files >= threshold:
             new_directory = os.path.join(download_directory, account)
             try:
                 os.mkdir(new_directory)
+                new_directories.add(account)
                 log.info(f"Created new directory {new_directory} (found {media_files} files)")
             except FileExistsError:
                 log.debug(f"Directory {new_directory} already exists")
         else:
             log.debug(f"Not enough media files to create directory {account} (found {media_files})")
 
+    return new_directories
 
-def _get_all_subdirectories(download_directory: str) -> List[str]:
-    """
-    Scan the download directory and returns all available subdirectories.
 
-    :param download_directory: media files download directory
-    :return: list of subdirectory names found in download_directory
+def _move_file(download_directory: str, filename: str, destination: str) -> bool:
     """
-    subdirectories = []
-    with os.scandir(download_directory) as dir_iterator:
-        for entry in dir_iterator:
-            if entry.is_dir():
-                subdirectories.append(entry.name)
-
-    log.debug(f"Found {len(subdirectories)} existing subdirectories")
-    return subdirectories
-
+    Move a file into a subdirectory of the download directory.
 
-def _move_files_to_subdirectory(download_directory: str, available_directories: List[str]):
+    :param download_directory: path to download directory
+    :param filename: name of the file to move
+    :param destination: destination path, relative to download_directory
+    :return: True if the file has been moved, False otherwise
+    """
+    full_filename_path = os.path.join(download_directory, filename)
+    full_destination_path = os.path.join(download_directory, destination)
+    try:
+        log.info(f"Moving {filename} into {destination}")
+        # Same as os.rename() on the same filesystem, falls back to a copy (with sendfile() on Linux) across filesystems
+        shutil.move(full_filename_path, full_destination_path)
+        log.debug(f"Moved {full_filename_path} into {full_destination_path}")
+        return True
+    except OSError as e:
+        log.error(f"Failed to move file {full_filename_path} to {full_destination_path}: {e}")
+        return False
+
+
+def _move_files_to_subdirectory(
+    download_directory: str, available_directories: Set[str], files_by_account: Dict[str, List[str]]
+):
     """
     Moves all files that have a matching subdirectory
 
     :param download_directory: path to download directory
-    :param available_directories: list of subdirectories found in download_directory
+    :param available_directories: set of subdirectories found in download_directory
+    :param files_by_account: dictionary with account name as key and list of its media file names as value
     """
-    files_to_move = defaultdict(list)
-
-    # First generate a list of files to be moved, we don't want to change the structure of the directory while we are
-    # scanning it.
-    with os.scandir(download_directory) as dir_iterator:
-        for entry in dir_iterator:
-            if not entry.is_file(follow_symlinks=False):
-                continue
-
-            try:
-                account_name = groupdict_from_filename(entry.name)["account"]
-            except ValueError:
-                continue
-
-            if account_name in available_directories:
-                files_to_move[account_name].append(entry.name)
-                log.debug(f"File {entry.name} will be moved into subdirectory {account_name}")
+    files_to_move = {
+        account: filenames for account, filenames in files_by_account.items() if account in available_directories
+    }
 
     if not files_to_move:
         log.info("No files need to be moved")
         return
 
-    # Move files
-    for subdirectory in files_to_move:
-        for filename in files_to_move[subdirectory]:
-            full_filename_path = os.path.join(download_directory, filename)
-            full_destination_path = os.path.join(download_directory, subdirectory, filename)
-            try:
-                log.info(f"Moving {filename} into {os.path.join(subdirectory, filename)}")
-                os.rename(full_filename_path, full_destination_path)
-                log.debug(f"Moved {full_filename_path} into {full_destination_path}")
-            except OSError as e:
-                log.error(f"Failed to move file {full_filename_path} to {full_destination_path}: {e}")
+    # Move files, renames of different files are independent from each other and can run concurrently
+    relative_paths = [
+        (filename, os.path.join(subdirectory, filename))
+        for subdirectory, filenames in files_to_move.items()
+        for filename in filenames
+    ]
+    with ThreadPoolExecutor(max_workers=MAX_MOVE_WORKERS) as executor:
+        results = list(executor.map(lambda paths: _move_file(download_directory, *paths), relative_paths))
 
+    failed_moves = results.count(False)
+    if failed_moves:
+        log.error(f"Failed to move {failed_moves} of {len(results)} files")
 
-def _scan_directory(download_directory: str) -> Dict[str, int]:
+
+def _scan_directory(download_directory: str) -> Tuple[Dict[str, int], Set[str], Dict[str, List[str]]]:
     """
-    Given the download directory, scan all its files and build a dictionary with Tweet's author's account name as key
-    and media count as value.
+    Given the download directory, scan all its entries in a single pass and return:
+      - a dictionary with Tweet's author's account name as key and media count as value;
+      - the set of all available subdirectories;
+      - a dictionary with Tweet's author's account name as key and the list of its media file names as value.
 
     :param download_directory: path to download directory
-    :return: dictionary with account name as key and media file count as value
+    :return: tuple of media count dictionary, subdirectories set and media files dictionary
     """
-    media_count: Dict[str, int] = defaultdict(lambda: 0)
+    media_count: Dict[str, int] = Counter()
+    subdirectories = set()
+    files_by_account = defaultdict(list)
 
+    # Files are only collected here, we don't want to change the structure of the directory while we are scanning it.
+    # The debug messages are only built if they are logged, as this runs for every file in the download directory.
+    debug_enabled = log.isEnabledFor(logging.DEBUG)
     with os.scandir(download_directory) as dir_iterator:
         for entry in dir_iterator:
+            if entry.is_dir():
+                subdirectories.add(entry.name)
+                continue
+
             if not entry.is_file(follow_symlinks=False):
-                log.debug(f"{entry.name} is not a file")
+                if debug_enabled:
+                    log.debug(f"{entry.name} is not a file")
                 continue
 
             try:
                 account_name = groupdict_from_filename(entry.name)["account"]
-                log.debug(f"Found account name {account_name} from file {entry.name}")
+                if debug_enabled:
+                    log.debug(f"Found account name {account_name} from file {entry.name}")
                 media_count[account_name] += 1
+                files_by_account[account_name].append(entry.name)
             except ValueError:
-                log.debug(f"Unable to find an account name in filename {entry.name}")
+                if debug_enabled:
+                    log.debug(f"Unable to find an account name in filename {entry.name}")
 
-    return media_count
+    log.debug(f"Found {len(subdirectories)} existing subdirectories")
+    return media_count, subdirectories, files_by_account
@@ -1,30 +1,51 @@
 """
 Download and manage media.
 """
-import configparser
+import atexit
 import logging
-import os.path
-from datetime import datetime
-from typing import Tuple
-from urllib.parse import urlparse
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterable, List, Optional, Set, Tuple
 
 import requests
 import tweepy  # type: ignore
+from requests.adapters import HTTPAdapter
 from tenacity import (
+    RetryCallState,
     after_log,
     retry,
     retry_if_exception_type,
     stop_after_attempt,
     stop_after_delay,
+    wait_chain,
     wait_fixed,
+    wait_random_exponential,
 )
 
-from modules import config, twitter
+from modules import twitter
+from modules.config import DownloadContext
+from modules.utils import groupdict_from_filename, isdir_cached
 
 HTTP_GET_TIMEOUT = 5
+# Downloads are streamed to disk in chunks of this size (in bytes)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Failed downloads are not retried after this long (in seconds)
+RETRY_STOP_DELAY = 5 * 60
+# Longest wait (in seconds) before retrying a rate limited download, so that a download thread is never blocked longer
+# than the retry period
+MAX_RETRY_AFTER = RETRY_STOP_DELAY
 
 log = logging.getLogger()
 
+# HTTP session shared by all downloads, so that connections to the media servers are kept alive and reused
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+atexit.register(_SESSION.close)
+
 
 class DownloadFailed(Exception):
     """Generic module exception."""
@@ -32,26 +53,41 @@ class DownloadFailed(Exception):
     ...
 
 
+class RateLimited(DownloadFailed):
+    """The server refused the download because too many requests have been made (HTTP 429)."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        # Seconds to wait before retrying, as requested by the server
+        self.retry_after = retry_after
+
+
 def download_media(
-    tweet: tweepy.models.Status, configuration: configparser.ConfigParser, force_download: bool = False
+    tweet: tweepy.models.Status, context: DownloadContext, force_download: bool = False, max_workers: int = 1
 ) -> Tuple[int, bool]:
     """
     Given a tweet, download all media it contains.
 
     :param tweet: Tweet to download
-    :param configuration: initialized ConfigParser object
+    :param context: DownloadContext built from configuration
     :param force_download: do not check if the files to download already exist on disk
+    :param max_workers: maximum number of media files of the tweet to download concurrently
     :return: tuple with number of media files downloaded and bool value, False if no media was found in the tweet
     """
-    tweet_media_count = 0
     urls_list = twitter.get_all_media_from_tweet(tweet)
     if not urls_list:
         return 0, False
 
-    for index, (url, requires_size_info) in enumerate(urls_list):
+    # The tweet's details are the same for all its media files
+    username = tweet.user.screen_name
+    filename_prefix = _build_filename_prefix(tweet)
+
+    # Build the list of files to download first, so that nothing is fetched if the media is already on disk
+    downloads_list = []
+    for index, url in enumerate(urls_list):
         extension = _get_file_extension_from_url(url)
-        dst_filename = _build_filename(tweet, index + 1, extension)
-        dst_filepath, extra_filepath = _build_filepath(configuration, dst_filename, tweet)
+        dst_filename = f"{filename_prefix}_{index + 1}.{extension}"
+        dst_filepath, extra_filepath = _build_filepath(context.download_directory, dst_filename, username)
 
         # If the file is already on disk, and download is not forced, abort download and return True
         if force_download:
@@ -60,65 +96,90 @@ def download_media(
             log.debug("Assuming all media in this tweet is already on disk")
             return 0, True
 
-        # Pictures require size information to download in high quality
-        if requires_size_info:
-            url = url + f"?format={extension}&name=large"
-            log.debug(f"Adding size info to URL: {url}")
+        downloads_list.append((url, dst_filename, dst_filepath))
+
+    _download_all(downloads_list, max_workers)
+    return len(downloads_list), True
+
+
+def find_tweets_on_disk(download_directory: str, tweet_ids: Iterable[str]) -> Set[str]:
+    """
+    Find which tweets already have media files in the download directory or in its account subdirectories, using
+    only the file names. This doesn't require the tweets to be loaded. As with download_media(), a tweet is
+    considered downloaded as soon as one of its media files is on disk.
+
+    :param download_directory: path to download directory
+    :param tweet_ids: IDs of the tweets to look for
+    :return: set of the tweet IDs found on disk
+    """
+    wanted_tweet_ids = set(tweet_ids)
+    found_tweet_ids: Set[str] = set()
+    try:
+        subdirectories = _collect_tweet_ids_in_directory(download_directory, wanted_tweet_ids, found_tweet_ids)
+    except (FileNotFoundError, NotADirectoryError):
+        return found_tweet_ids
+    for subdirectory in subdirectories:
+        _collect_tweet_ids_in_directory(subdirectory, wanted_tweet_ids, found_tweet_ids)
+    return found_tweet_ids
 
-        log.info(f"Downloading {dst_filename}")
-        content = _download_url(url)
-        _write_to_disk(dst_filepath, content)
-        log.debug(f"Written to disk {dst_filename}")
-        tweet_media_count += 1
 
-    return tweet_media_count, True
+def set_max_connections(max_connections: int):
+    """
+    Size the HTTP connection pool for the number of concurrent downloads. If more workers than pooled connections
+    download from the same server, the extra connections are discarded after each download and opened again (with a new
+    TLS handshake) for the next one.
+
+    :param max_connections: maximum number of connections kept alive for each media server
+    """
+    _SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=max_connections, max_retries=0))
 
 
-def _build_filename(tweet: tweepy.models.Status, media_count: int, extension: str) -> str:
+def _build_filename_prefix(tweet: tweepy.models.Status) -> str:
     """
-    Build the destination filename given the tweet's details and the index number of the object in the tweet's media.
-    The file name is formatted as follows:
+    Build the part of the destination filename that depends only on the tweet's details. The full file name is
+    completed with the index number of the object in the tweet's media and is formatted as follows:
         {user}_{date}_{ID}_{file_number}.{extension}
     Example:
         koirakoirana_2022-08-09_1557022684373983234_1.jpg
 
     :param tweet: tweet to process
-    :param media_count: media file number
-    :param extension: file extension
-    :return: destination filename
+    :return: destination filename prefix, ie. 'koirakoirana_2022-08-09_1557022684373983234'
     """
     source_user = tweet.user.screen_name
     tweet_time = datetime.strftime(tweet.created_at, "%Y-%m-%d")
     tweet_id = tweet.id_str
-    return f"{source_user}_{tweet_time}_{tweet_id}_{media_count}.{extension}"
+    return f"{source_user}_{tweet_time}_{tweet_id}"
 
 
-def _build_filepath(
-    configuration: configparser.ConfigParser, filename: str, tweet: tweepy.models.Status
-) -> Tuple[str, str]:
+def _build_filepath(directory: str, filename: str, username: str) -> Tuple[str, str]:
     """
     Build the download filepath.
 
-    :param configuration: initialized ConfigParser object
+    :param directory: download directory
+    :param filename: destination filename
+    :param username: screen name of the tweet's author
     :return: final destination filepath and extra path if a subdirectory with the author's name exists (empty otherwise)
     """
-    directory = config.get_download_directory(configuration)
-    if not os.path.isdir(directory):
+    if not isdir_cached(directory):
         log.error(f"Specified download path {directory} is not a valid directory")
         raise DownloadFailed(f"Failed to validate path {directory}")
 
     download_filepath = os.path.join(directory, filename)
 
     # If a subdirectory for the author already exists, return the extra path (directory/author/filename)
-    username = tweet.user.screen_name
-    if os.path.isdir(os.path.join(directory, username)):
-        log.debug(f"Found subdirectory {username}")
+    if isdir_cached(os.path.join(directory, username)):
         extra_path = os.path.join(directory, username, filename)
-        log.debug(f"Final download path is {download_filepath}, but will also check {extra_path}")
     else:
-        log.debug(f"Final download path is {download_filepath}")
         extra_path = ""
 
+    # Called for every media file, the debug messages are only built if they are logged
+    if log.isEnabledFor(logging.DEBUG):
+        if extra_path:
+            log.debug(f"Found subdirectory {username}")
+            log.debug(f"Final download path is {download_filepath}, but will also check {extra_path}")
+        else:
+            log.debug(f"Final download path is {download_filepath}")
+
     return download_filepath, extra_path
 
 
@@ -129,11 +190,19 @@ def _check_file_already_on_disk(filepath: str) -> bool:
     :param filepath: destination file path
     :return: True if the file exists, False otherwise
     """
-    if not filepath or not os.path.isfile(filepath):
+    if not filepath:
+        return False
+
+    # A single stat() call gives both the file type and its size
+    try:
+        file_stat = os.stat(filepath)
+    except OSError:
+        return False
+    if not stat.S_ISREG(file_stat.st_mode):
         return False
 
     # If the file exists and its size is 0, allow overwrites (possibly a failed download)
-    if os.path.getsize(filepath) > 0:
+    if file_stat.st_size > 0:
         log.debug(f"File {filepath} already on disk.")
         return True
     else:
@@ -141,27 +210,127 @@ def _check_file_already_on_disk(filepath: str) -> bool:
         return False
 
 
+def _collect_tweet_ids_in_directory(directory: str, tweet_ids: Set[str], found_tweet_ids: Set[str]) -> List[str]:
+    """
+    Scan a directory for media files of the specified tweets and add the IDs found to found_tweet_ids. Empty files
+    (possibly failed downloads) are ignored.
+
+    :param directory: path to directory to scan
+    :param tweet_ids: IDs of the tweets to look for
+    :param found_tweet_ids: set of tweet IDs found on disk, updated in place
+    :return: list of the paths of the subdirectories
+    """
+    subdirectories = []
+    with os.scandir(directory) as dir_iterator:
+        for entry in dir_iterator:
+            if entry.is_dir():
+                subdirectories.append(entry.path)
+                continue
+            try:
+                tweet_id = groupdict_from_filename(entry.name)["id"]
+            except ValueError:
+                continue
+            if tweet_id in tweet_ids and entry.is_file() and entry.stat().st_size > 0:
+                found_tweet_ids.add(tweet_id)
+    return subdirectories
+
+
+def _download_all(downloads_list: List[Tuple[str, str, str]], max_workers: int):
+    """
+    Download the media files of a tweet, concurrently if more than one worker is allowed.
+
+    :param downloads_list: list of URL, destination filename and destination filepath tuples
+    :param max_workers: maximum number of files to download concurrently
+    :raise DownloadFailed: if any of the downloads failed
+    """
+
+    def download(url: str, dst_filename: str, dst_filepath: str):
+        log.info(f"Downloading {dst_filename}")
+        _download_to_file(url, dst_filepath)
+        log.debug(f"Written to disk {dst_filename}")
+
+    if max_workers < 2 or len(downloads_list) < 2:
+        for url, dst_filename, dst_filepath in downloads_list:
+            download(url, dst_filename, dst_filepath)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(downloads_list))) as executor:
+        futures = [executor.submit(download, *download_args) for download_args in downloads_list]
+    # Raise the first failure, if any, once all downloads are over
+    for future in futures:
+        future.result()
+
+
+_WAIT_DOWNLOAD_FAILED = wait_random_exponential(multiplier=1, max=60)
+_WAIT_RATE_LIMITED = wait_chain(*[wait_fixed(60 * 2**i) for i in range(4)])
+
+
+def _wait_before_retry(retry_state: RetryCallState) -> float:
+    """
+    Compute how long to wait before retrying a failed download. Back off exponentially with random jitter, and wait a
+    lot longer if the server is rate limiting us, so we don't extend the rate limit window by hammering it. If the
+    server said when to retry, wait for that long instead.
+
+    :param retry_state: tenacity state of the current call
+    :return: seconds to wait
+    """
+    outcome = retry_state.outcome
+    exception = outcome.exception() if outcome is not None else None
+    if isinstance(exception, RateLimited):
+        if exception.retry_after is not None:
+            return min(exception.retry_after, MAX_RETRY_AFTER)
+        return min(_WAIT_RATE_LIMITED(retry_state), MAX_RETRY_AFTER)
+    return _WAIT_DOWNLOAD_FAILED(retry_state)
+
+
 @retry(
-    stop=(stop_after_attempt(5) | stop_after_delay(60)),
-    wait=wait_fixed(3),
+    stop=(stop_after_attempt(5) | stop_after_delay(RETRY_STOP_DELAY)),
+    wait=_wait_before_retry,
     retry=retry_if_exception_type(DownloadFailed),
     reraise=True,
     after=after_log(log, logging.WARNING),
 )
-def _download_url(url: str) -> bytes:
+def _download_to_file(url: str, filepath: str):
     """
-    Make a HTTP GET request.
+    Make a HTTP GET request and stream the response content to a temporary file, which replaces the destination once
+    complete. The destination is never left partially written, even if the process is killed, so that an incomplete
+    download is not mistaken for a complete one later.
 
     :param url: URL to download
-    :return: response content as bytes
-    :raise DownloadFailed: on HTTP GET failure
+    :param filepath: destination filepath
+    :raise RateLimited: on HTTP 429 response
+    :raise DownloadFailed: on HTTP GET or disk write failure, or if less data than announced by the server was received
     """
+    tmp_filepath = f"{filepath}.part"
     try:
-        response = requests.get(url, timeout=HTTP_GET_TIMEOUT)
-        response.raise_for_status()
+        with closing(_SESSION.get(url, stream=True, timeout=HTTP_GET_TIMEOUT)) as response:
+            response.raise_for_status()
+            with open(tmp_filepath, "wb") as fd:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    fd.write(chunk)
+                written_size = fd.tell()
+
+            # Files on disk are assumed to be complete, make sure the whole content has been received. The announced
+            # length can only be compared with the written size if the content isn't compressed.
+            expected_size = response.headers.get("Content-Length", "")
+            if (
+                expected_size.isdigit()
+                and "Content-Encoding" not in response.headers
+                and written_size != int(expected_size)
+            ):
+                _remove_partial_file(tmp_filepath)
+                raise DownloadFailed(f'Incomplete download of "{url}": got {written_size} of {expected_size} bytes')
+        os.replace(tmp_filepath, filepath)
     except requests.RequestException as e:
+        _remove_partial_file(tmp_filepath)
+        if e.response is not None and e.response.status_code == 429:
+            retry_after = _parse_retry_after(e.response.headers.get("Retry-After"))
+            raise RateLimited(f'Rate limited while trying to GET "{url}": {e}', retry_after)
         raise DownloadFailed(f'Failed to GET "{url}": {e}')
-    return response.content
+    except IOError as e:
+        log.error(f"Failed to write file {filepath} to disk: {e}")
+        _remove_partial_file(tmp_filepath)
+        raise DownloadFailed(e)
 
 
 def _get_file_extension_from_url(url: str) -> str:
@@ -171,26 +340,51 @@ def _get_file_extension_from_url(url: str) -> str:
     :param url: file's URL
     :return: file's extension
     """
-    parsed_url = urlparse(url)
-    split_path = os.path.splitext(parsed_url.path)
-
-    # Get the extension but remove the leading '.' for easier handling
-    extension = split_path[1][1:]
-    log.debug(f"Found '{extension}' file extension in URL {url}")
+    # Twitter media URLs are simple enough that a full URL parse is not needed: strip the query string, keep the last
+    # path segment and get the extension without the leading '.' for easier handling
+    filename = url.partition("?")[0].rpartition("/")[2]
+    _, dot, extension = filename.rpartition(".")
+    if not dot:
+        extension = ""
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"Found '{extension}' file extension in URL {url}")
     return extension
 
 
-def _write_to_disk(filepath: str, content: bytes):
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
     """
-    Write downloaded binary content to disk
+    Parse the value of a Retry-After HTTP header, either a number of seconds or a date.
 
-    :param filepath: destination filepath
-    :param content: binary content
-    :raise DownloadFailed: on disk write failure
+    :param value: header value, None if the header is missing
+    :return: seconds to wait before retrying, None if the header is missing or invalid
     """
+    if not value:
+        return None
     try:
-        with open(filepath, "wb") as fd:
-            fd.write(content)
-    except IOError as e:
-        log.error(f"Failed to write file {filepath} to disk: {e}")
-        raise DownloadFailed(e)
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        log.debug(f"Ignoring invalid Retry-After header: {value}")
+        return None
+    # A '-0000' zone gives a naive datetime, HTTP dates are always in UTC
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+def _remove_partial_file(filepath: str):
+    """
+    Remove a file left behind by a failed download, if any.
+
+    :param filepath: path to the incomplete file
+    """
+    try:
+        os.remove(filepath)
+        log.debug(f"Removed incomplete file {filepath}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning(f"Failed to remove incomplete file {filepath}: {e}")
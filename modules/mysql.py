@@ -1,10 +1,17 @@
 import logging
 from configparser import ConfigParser
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, Optional, Sequence, Tuple
 
-from MySQLdb import Connection, MySQLError, _mysql
+import MySQLdb
+from MySQLdb import Connection, MySQLError
+from MySQLdb.cursors import SSCursor
 
 from .config import get_photoprism_db_config
 
+# Number of rows fetched at once from the server when streaming the result of a query
+STREAM_BATCH_SIZE = 1000
+
 log = logging.getLogger()
 
 
@@ -21,22 +28,90 @@ def connect(configuration: ConfigParser) -> Connection:
         log.error(f"Failed to connect to SQL server: {e}")
         raise
     port = int(auth_dict.pop("port"))  # 'port' must be an integer
-    return _mysql.connect(port=port, **auth_dict)
+    # Every statement is committed as soon as it's executed. Text columns are decoded by the client library.
+    return MySQLdb.connect(port=port, autocommit=True, charset="utf8mb4", use_unicode=True, **auth_dict)
 
 
-def execute_query(connection: Connection, query: str) -> _mysql.result:
+def execute_query(connection: Connection, query: str, params: Optional[Sequence[Any]] = None) -> Tuple[Tuple, ...]:
     """
+    Execute a query, with its values bound to the '%s' placeholders by the client library, and return its result.
 
-    :param connection:
-    :param query:
-    :return:
+    :param connection: initialized MySQLdb connection to database
+    :param query: query with optional '%s' placeholders, ie. "SELECT id FROM labels WHERE label_slug = %s"
+    :param params: values to bind to the query placeholders
+    :return: rows returned by the query, empty if the query doesn't return any result
     """
+    cursor = connection.cursor()
     try:
         log.debug(f'Executing query "{query}"')
-        connection.query(query)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    except MySQLError as e:
+        log.error(f"Failed to query database: {e}")
+        log.error(f'Query was: "{query}"')
+        raise
+    finally:
+        cursor.close()
+
+
+def execute_many(connection: Connection, query: str, rows: Iterable[Sequence[Any]]) -> int:
+    """
+    Execute a parameterized query for each row of values. MySQLdb sends 'INSERT ... VALUES' queries to the server as a
+    single multi-row statement, as long as the VALUES clause only contains placeholders.
+
+    :param connection: initialized MySQLdb connection to database
+    :param query: query with '%s' placeholders, ie. "INSERT INTO labels (id, label_slug) VALUES (%s, %s)"
+    :param rows: values to bind to the query placeholders, one sequence per row
+    :return: number of affected rows
+    """
+    cursor = connection.cursor()
+    try:
+        log.debug(f'Executing query "{query}" for multiple rows')
+        return cursor.executemany(query, rows)
+    except MySQLError as e:
+        log.error(f"Failed to query database: {e}")
+        log.error(f'Query was: "{query}"')
+        raise
+    finally:
+        cursor.close()
+
+
+def stream_query(connection: Connection, query: str, params: Optional[Sequence[Any]] = None) -> Iterator[Tuple]:
+    """
+    Execute a query and yield the rows of its result as they are received from the server, without loading the whole
+    result in memory. All rows must be consumed before executing another query on the same connection.
+
+    :param connection: initialized MySQLdb connection to database
+    :param query: query with optional '%s' placeholders, ie. "SELECT id FROM labels WHERE label_slug = %s"
+    :param params: values to bind to the query placeholders
+    :return: iterator over the rows returned by the query
+    """
+    cursor = connection.cursor(SSCursor)
+    try:
+        log.debug(f'Streaming result of query "{query}"')
+        cursor.execute(query, params)
+        while rows := cursor.fetchmany(STREAM_BATCH_SIZE):
+            yield from rows
     except MySQLError as e:
         log.error(f"Failed to query database: {e}")
         log.error(f'Query was: "{query}"')
         raise
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def transaction(connection: Connection) -> Iterator[None]:
+    """
+    Run the queries executed in the context as a single transaction, committed on exit and rolled back on error.
 
-    return connection.store_result()
+    :param connection: initialized MySQLdb connection to database
+    """
+    connection.begin()
+    try:
+        yield
+    except BaseException:
+        log.error("Rolling back transaction")
+        connection.rollback()
+        raise
+    connection.commit()
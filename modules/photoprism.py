@@ -2,12 +2,13 @@ import logging
 from configparser import ConfigParser
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set, Tuple
 
 import yaml
 from MySQLdb import Connection
 
 from . import config, mysql
+from .utils import load_yaml_file, write_file_atomically
 
 # Timestamp format used by PhotoPrism
 PHOTOPRISM_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -20,6 +21,9 @@ IMAGE_PROCESSED_BY_TAGGER_LABEL = "hermes-conrad-was-here"
 # Slug of the album to use to store recent pictures
 RECENT_ALBUM_SLUG = "recent"
 
+# UIDs of the albums already looked up, with their slug as key
+_ALBUM_UIDS: Dict[str, str] = {}
+
 log = logging.getLogger()
 
 
@@ -56,20 +60,25 @@ def label_known_artists(connection: Connection, configuration: ConfigParser):
 
     tagmap_filepath = config.get_tagmap_file(configuration)
     tagmap = _load_tagmap_file(tagmap_filepath)
-    available_labels = _get_all_available_labels(connection)
-    processed_by_tagger_label = _get_tagger_label(available_labels)
+    labels_by_slug = {label.slug: label for label in _get_all_available_labels(connection)}
+    processed_by_tagger_label = _get_tagger_label(labels_by_slug)
 
-    # Go through the artists in tagmap file and check all their pictures
+    # Go through the artists in tagmap file, then check all their pictures and assign all missing labels at once
+    expected_labels_by_user: Dict[str, List[Label]] = {}
     for twitter_user, required_labels_for_user in tagmap.items():
-        _label_pictures_for_user(
-            connection, twitter_user, available_labels, required_labels_for_user, processed_by_tagger_label
-        )
+        expected_labels = _get_expected_labels_for_user(twitter_user, labels_by_slug, required_labels_for_user)
+        if expected_labels is not None:
+            expected_labels_by_user[twitter_user] = expected_labels
+
+    labels_to_add = _find_missing_labels(connection, expected_labels_by_user, processed_by_tagger_label)
+    _add_labels_to_pictures(connection, labels_to_add)
 
 
 def update_recent_pictures_album(connection: Connection, configuration: ConfigParser):
     """
     Find all the recent media (items added to PhotoPrism between now and the time specified in the configuration) and
-    add them to the 'Recent' album
+    make them the content of the 'Recent' album. Only the media that entered or left the time window are added to or
+    removed from the album.
 
     :param connection: initialized MySQLdb connection to database
     :param configuration: initialized ConfigParser object
@@ -83,31 +92,49 @@ def update_recent_pictures_album(connection: Connection, configuration: ConfigPa
     delta_hours = config.get_photoprism_utility_config(configuration)["recent_media_hours_delta"]
     search_limit = datetime.now() - timedelta(hours=int(delta_hours))
     picture_uids = _get_picture_uids_after_timestamp(connection, search_limit)
-    log.info(f"Adding {len(picture_uids)} media items to album")
 
-    # Replace the recent media in album
-    _delete_all_media_in_album(connection, recent_album_uid)
-    _add_media_to_album(connection, recent_album_uid, picture_uids)
+    # Update the album with the differences only
+    album_picture_uids = _get_media_in_album(connection, recent_album_uid)
+    expired_picture_uids = album_picture_uids - picture_uids
+    new_picture_uids = picture_uids - album_picture_uids
+    log.info(f"Adding {len(new_picture_uids)} and removing {len(expired_picture_uids)} media items in album")
+    with mysql.transaction(connection):
+        _remove_media_from_album(connection, recent_album_uid, expired_picture_uids)
+        _add_media_to_album(connection, recent_album_uid, new_picture_uids)
 
 
-def _add_label_to_picture(connection: Connection, picture_id: str, label: Label):
+def _add_labels_to_pictures(connection: Connection, labels_to_add: List[Tuple[str, Label]]):
     """
-    Assign the specified label to the picture and update the counter in the 'labels' table.
+    Assign labels to pictures and update the counters in the 'labels' table. All labels are inserted with a single
+    multi-row statement and all counters are updated with a single statement, in the same transaction.
 
     :param connection: initialized MySQLdb connection to database
-    :param picture_id: PhotoPrism ID of the picture to search for
-    :param label: Label tuple to assign to the picture
+    :param labels_to_add: list of PhotoPrism picture IDs and Label tuples to assign to them
     """
-    log.debug(f"Adding label {label.slug} with ID {label.id} to picture {picture_id}")
-    query = (
-        "BEGIN NOT ATOMIC "
-        "INSERT INTO photos_labels (photo_id, label_id, label_src, uncertainty) "
-        f"VALUES ({picture_id}, {label.id}, 'manual', 0); "
-        "UPDATE labels SET photo_count = photo_count + 1 "
-        f"WHERE id = {label.id}; "
-        "END"
+    if not labels_to_add:
+        log.debug("No labels to add, aborting query")
+        return
+
+    # A label may have been assigned to a picture (by PhotoPrism or by a user) since the labels were fetched: such rows
+    # are left untouched. The counters of the labels are then computed again from their pictures rather than
+    # incremented, so that those rows are not counted twice.
+    log.debug("Adding %s labels to pictures", len(labels_to_add))
+    insert_query = (
+        "INSERT INTO photos_labels (photo_id, label_id, label_src, uncertainty) VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE label_id = label_id"
+    )
+    rows = [(picture_id, label.id, "manual", 0) for picture_id, label in labels_to_add]
+
+    label_ids = sorted({label.id for _, label in labels_to_add})
+    placeholders = ", ".join(["%s"] * len(label_ids))
+    update_query = (
+        "UPDATE labels l SET photo_count = (SELECT COUNT(*) FROM photos_labels pl WHERE pl.label_id = l.id) "
+        f"WHERE l.id IN ({placeholders})"
     )
-    mysql.execute_query(connection, query)
+
+    with mysql.transaction(connection):
+        mysql.execute_many(connection, insert_query, rows)
+        mysql.execute_query(connection, update_query, label_ids)
 
 
 def _add_media_to_album(connection: Connection, album_uid: str, picture_uids: Set[str]):
@@ -119,24 +146,20 @@ def _add_media_to_album(connection: Connection, album_uid: str, picture_uids: Se
     :param picture_uids: set of UIDs of the pictures to add
     """
     if not picture_uids:
-        log.debug(f"No images to add to album {album_uid}, aborting query")
+        log.debug("No images to add to album %s, aborting query", album_uid)
         return
 
-    log.debug(f"Adding {len(picture_uids)} media items to album {album_uid}")
+    log.debug("Adding %s media items to album %s", len(picture_uids), album_uid)
 
-    # Prepare all VALUES for the INSERT INTO operation
+    # Insert all pictures with a single multi-row statement
     now_timestamp = datetime.now().strftime(PHOTOPRISM_TIMESTAMP_FORMAT)
-    sql_values_elements = []
-    for picture_uid in picture_uids:
-        sql_values_elements.append(f"('{picture_uid}', '{album_uid}', 0, 0, 0, '{now_timestamp}', '{now_timestamp}')")
-    sql_values = ", ".join(sql_values_elements)
-
     query = (
         "INSERT INTO photos_albums "
         "(photo_uid, album_uid, photos_albums.order, hidden, missing, created_at, updated_at) "
-        f"VALUES {sql_values}"
+        "VALUES (%s, %s, %s, %s, %s, %s, %s)"
     )
-    mysql.execute_query(connection, query)
+    rows = ((picture_uid, album_uid, 0, 0, 0, now_timestamp, now_timestamp) for picture_uid in picture_uids)
+    mysql.execute_many(connection, query, rows)
 
 
 def _create_tagmap_file(filepath: str):
@@ -154,28 +177,65 @@ def _create_tagmap_file(filepath: str):
     )
     log.info(f"Creating new tag map file {filepath}")
     try:
-        with open(filepath, "w") as fd:
-            fd.write(comment)
+        write_file_atomically(filepath, comment)
     except IOError as e:
         log.error(f"Failed to write tag map file: {e}")
         raise
 
 
-def _delete_all_media_in_album(connection: Connection, album_uid: str):
+def _find_missing_labels(
+    connection: Connection, expected_labels_by_user: Dict[str, List[Label]], processed_by_tagger_label: Label
+) -> List[Tuple[str, Label]]:
     """
-    Remove the association between media and the specified album.
+    Find the labels that need to be assigned to the pictures of the specified Twitter users: the expected labels they
+    are missing, and the IMAGE_PROCESSED_BY_TAGGER_LABEL label. Pictures already labeled with the latter are skipped.
+    The expected labels are built as a derived table and matched against all pictures with a single query.
 
     :param connection: initialized MySQLdb connection to database
-    :param album_uid: UID of the album to empty
+    :param expected_labels_by_user: dictionary with Twitter user as key and list of Label tuples to associate with their
+      pictures as value
+    :param processed_by_tagger_label: Label tuple representing IMAGE_PROCESSED_BY_TAGGER_LABEL
+
+    :return: list of PhotoPrism picture IDs and Label tuples to assign to them
     """
-    log.debug(f"Deleting all media in ablum {album_uid}")
-    query = f"DELETE FROM photos_albums WHERE album_uid = '{album_uid}'"
-    mysql.execute_query(connection, query)
+    if not expected_labels_by_user:
+        return []
+
+    # Pictures are found with the naming convention of the Twitter scanner: their file name starts with the username
+    labels_by_id = {processed_by_tagger_label.id: processed_by_tagger_label}
+    rows = []
+    for twitter_user, expected_labels in expected_labels_by_user.items():
+        for label in expected_labels + [processed_by_tagger_label]:
+            labels_by_id[label.id] = label
+            # The label ID is bound as a number, for the NOT EXISTS lookups to use the photos_labels primary key
+            rows.append((f"{twitter_user}%", int(label.id)))
+
+    log.debug("Matching %s expected labels for %s users", len(rows), len(expected_labels_by_user))
+    expected_labels_query = " UNION ALL ".join(
+        ["SELECT %s AS photo_name_pattern, %s AS label_id"] + ["SELECT %s, %s"] * (len(rows) - 1)
+    )
+    select_query = (
+        "SELECT DISTINCT p.id, e.label_id FROM photos p "
+        f"JOIN ({expected_labels_query}) e ON p.photo_name LIKE e.photo_name_pattern "
+        "WHERE NOT EXISTS (SELECT 1 FROM photos_labels pl WHERE pl.photo_id = p.id AND pl.label_id = %s) "
+        "AND NOT EXISTS (SELECT 1 FROM photos_labels pl WHERE pl.photo_id = p.id AND pl.label_id = e.label_id)"
+    )
+    params = [value for row in rows for value in row] + [processed_by_tagger_label.id]
+    missing_labels = mysql.stream_query(connection, select_query, params)
+    labels_to_add = [(str(picture_id), labels_by_id[str(label_id)]) for picture_id, label_id in missing_labels]
+
+    updated_pictures_count = len({picture_id for picture_id, _ in labels_to_add})
+    if updated_pictures_count:
+        log.info(f"Found {updated_pictures_count} pictures to update")
+    else:
+        log.debug("No new pictures to update")
+    return labels_to_add
 
 
 def _get_album_uid(connection: Connection, album_slug: str) -> str:
     """
-    Search the album table of PhotoPrism and return the UID of the specified album.
+    Search the album table of PhotoPrism and return the UID of the specified album. The UID is only looked up once per
+    album.
 
     :param connection: initialized MySQLdb connection to database
     :param album_slug: slug of the album to lookup in the database
@@ -184,20 +244,26 @@ def _get_album_uid(connection: Connection, album_slug: str) -> str:
 
     :raise PhotoPrismException: if the query doesn't return exactly one record.
     """
-    log.debug(f"Looking up UID of PhotoPrism album with slug {album_slug}")
-    query = f"SELECT album_uid FROM albums WHERE album_slug = '{album_slug}'"
-    result = mysql.execute_query(connection, query)
-    result_rows = result.fetch_row(0)
+    if album_slug in _ALBUM_UIDS:
+        return _ALBUM_UIDS[album_slug]
+
+    # Two rows are enough to detect duplicate slugs
+    log.debug("Looking up UID of PhotoPrism album with slug %s", album_slug)
+    query = "SELECT CONVERT(album_uid USING utf8mb4) FROM albums WHERE album_slug = %s LIMIT 2"
+    result_rows = mysql.execute_query(connection, query, (album_slug,))
 
     if not result_rows:
         log.error(f"No PhotoPrism album with slug '{album_slug}' found in database. Please create it manually")
         raise PhotoPrismException(f"Unable to find PhotoPrism album with slug '{album_slug}'")
     elif len(result_rows) > 1:
-        log.error(f"Unexpected multiple results for album slug '{album_slug}': {', '.join(result_rows)}")
-        raise PhotoPrismException(f"Expecting exactly one UID for album '{album_slug}', got {len(result_rows)}")
+        log.error(
+            f"Unexpected multiple results for album slug '{album_slug}': {', '.join(row[0] for row in result_rows)}"
+        )
+        raise PhotoPrismException(f"Expecting exactly one UID for album '{album_slug}', got several")
 
-    album_uid = result_rows[0][0].decode("utf-8")
-    log.debug(f"Found UID {album_uid} for album {album_slug}")
+    album_uid = result_rows[0][0]
+    log.debug("Found UID %s for album %s", album_uid, album_slug)
+    _ALBUM_UIDS[album_slug] = album_uid
     return album_uid
 
 
@@ -209,55 +275,57 @@ def _get_all_available_labels(connection: Connection) -> List[Label]:
 
     :return: list of Label tuples found in database
     """
-    log.debug(f"Fetching available labels from DB")
-    query = "SELECT id, label_slug FROM labels"
-    result = mysql.execute_query(connection, query)
-
-    try:
-        return [Label(row[0].decode("utf-8"), row[1].decode("utf-8")) for row in result.fetch_row(0)]
-    except UnicodeDecodeError as e:
-        log.error(f"Failed to decode value with UTF-8: {e}")
-        raise
+    log.debug("Fetching available labels from DB")
+    # PhotoPrism stores slugs and UIDs in binary columns, convert them to text so that they are returned as str
+    query = "SELECT id, CONVERT(label_slug USING utf8mb4) FROM labels"
+    return [Label(str(row[0]), row[1]) for row in mysql.stream_query(connection, query)]
 
 
-def _get_label_ids_for_picture(connection: Connection, picture_id: str) -> Set[str]:
+def _get_expected_labels_for_user(
+    twitter_user: str, labels_by_slug: Dict[str, Label], required_labels_for_user: List[str]
+) -> Optional[List[Label]]:
     """
-    Find the label IDs associated with the specified picture ID.
+    Find the labels that should be assigned to all pictures of the specified Twitter user.
 
-    :param connection: initialized MySQLdb connection to database
-    :param picture_id: PhotoPrism ID of the picture to search for
+    :param twitter_user: Twitter user to process
+    :param labels_by_slug: dictionary of Label tuples available in the database, with their slug as key
+    :param required_labels_for_user: list of label slugs that should be assigned to all pictures
 
-    :return: set of IDs of labels associated with the picture
+    :return: list of Label tuples, None if one or more of the required labels do not exist in the database
     """
-    log.debug(f"Fetching label IDs for picture {picture_id}")
-    query = f"SELECT label_id FROM photos_labels WHERE photo_id = {picture_id}"
-    result = mysql.execute_query(connection, query)
-    try:
-        return {row[0].decode("utf-8") for row in result.fetch_row(0)}
-    except UnicodeDecodeError as e:
-        log.error(f"Failed to decode label_id value with UTF-8: {e}")
-        raise
+    log.debug("Processing twitter user %s", twitter_user)
 
+    # Get the IDs of the labels that should be applied to the pictures, ignoring slugs listed more than once
+    required_slugs = set(required_labels_for_user)
+    expected_labels = [labels_by_slug[slug] for slug in required_slugs & labels_by_slug.keys()]
+    missing_slugs = required_slugs - labels_by_slug.keys()
 
-def _get_picture_ids_for_user(connection: Connection, twitter_user: str) -> Set[str]:
+    # Throw an error if one or more required label IDs do not exist in the database
+    if missing_slugs:
+        log.error(
+            f"One or more required labels for user {twitter_user} are missing, cannot continue. "
+            f"Please assign the following labels to at least one picture: {', '.join(sorted(missing_slugs))}"
+        )
+        return None
+    elif log.isEnabledFor(logging.DEBUG):
+        found_labels = ", ".join(f"{label.slug} (id={label.id})" for label in expected_labels)
+        log.debug("Found required labels %s for user %s", found_labels, twitter_user)
+
+    return expected_labels
+
+
+def _get_media_in_album(connection: Connection, album_uid: str) -> Set[str]:
     """
-    Search the PhotoPrism database for all the pictures associated with the specified user. The search is pretty dumb
-    and relies on the naming convention of the Twitter scanner. It expect the picture's file name to start with the
-    username we are looking for.
+    Search the PhotoPrism database for the UIDs of all the media in the specified album.
 
     :param connection: initialized MySQLdb connection to database
-    :param twitter_user: Twitter user to search for
+    :param album_uid: UID of the album
 
-    :return: set of picture IDs associated with the user
+    :return: set of UIDs of the pictures in the album
     """
-    log.debug(f"Fetching picture IDs for user {twitter_user}")
-    query = f"SELECT id FROM photos WHERE photo_name LIKE '{twitter_user}%'"
-    result = mysql.execute_query(connection, query)
-    try:
-        return {id_num[0].decode("utf-8") for id_num in result.fetch_row(0)}
-    except UnicodeDecodeError as e:
-        log.error(f"Failed to decode ID value with UTF-8: {e}")
-        raise
+    log.debug("Fetching picture UIDs in album %s", album_uid)
+    query = "SELECT CONVERT(photo_uid USING utf8mb4) FROM photos_albums WHERE album_uid = %s"
+    return {uid_num[0] for uid_num in mysql.stream_query(connection, query, (album_uid,))}
 
 
 def _get_picture_uids_after_timestamp(connection: Connection, timestamp: datetime) -> Set[str]:
@@ -271,141 +339,41 @@ def _get_picture_uids_after_timestamp(connection: Connection, timestamp: datetim
     :return: set of picture UIDs added after the specified timestamp
     """
     sql_timestamp = timestamp.strftime(PHOTOPRISM_TIMESTAMP_FORMAT)
-    log.debug(f"Fetching picture UIDs added to PhotoPrism after {sql_timestamp}")
-    query = f"SELECT photo_uid FROM photos WHERE created_at > '{sql_timestamp}'"
-    result = mysql.execute_query(connection, query)
-    try:
-        return {uid_num[0].decode("utf-8") for uid_num in result.fetch_row(0)}
-    except UnicodeDecodeError as e:
-        log.error(f"Failed to decode ID value with UTF-8: {e}")
-        raise
+    log.debug("Fetching picture UIDs added to PhotoPrism after %s", sql_timestamp)
+    query = "SELECT CONVERT(photo_uid USING utf8mb4) FROM photos WHERE created_at > %s"
+    return {uid_num[0] for uid_num in mysql.stream_query(connection, query, (sql_timestamp,))}
 
 
-def _get_tagger_label(available_labels: List[Label]) -> Label:
+def _get_tagger_label(labels_by_slug: Dict[str, Label]) -> Label:
     """
     Check if IMAGE_PROCESSED_BY_TAGGER_LABEL exists in the DB, we don't create it here to avoid messing too much with
     the database.
 
-    :param available_labels: list of Label tuples as returned by _get_all_available_labels()
+    :param labels_by_slug: dictionary of Label tuples available in the database, with their slug as key
 
     :return: Label tuple for the tagger
 
     :raise TaggerException: if the tagger label doesn't exist in the database
     """
-    for label in available_labels:
-        if label.slug == IMAGE_PROCESSED_BY_TAGGER_LABEL:
-            log.debug(f"Found tagger label {label.slug} in database")
-            return label
+    if IMAGE_PROCESSED_BY_TAGGER_LABEL in labels_by_slug:
+        log.debug("Found tagger label %s in database", IMAGE_PROCESSED_BY_TAGGER_LABEL)
+        return labels_by_slug[IMAGE_PROCESSED_BY_TAGGER_LABEL]
 
     log.error(f"Tagger label {IMAGE_PROCESSED_BY_TAGGER_LABEL} not found, please create it manually")
     raise PhotoPrismException(f"Required label {IMAGE_PROCESSED_BY_TAGGER_LABEL} not found in database")
 
 
-def _label_picture(
-    connection: Connection,
-    picture_id: str,
-    expected_labels: List[Label],
-    processed_by_tagger_label: Label,
-) -> bool:
-    """
-    Ensure the specified picture has all the expected labels associated to it. Skip processing if the picture is labeled
-    with IMAGE_PROCESSED_BY_TAGGER_LABEL.
-
-    :param connection: initialized MySQLdb connection to database
-    :param picture_id: PhotoPrism ID of the picture to process
-    :param expected_labels: list of Label tuples to associate with the picture
-    :param processed_by_tagger_label: Label tuple representing IMAGE_PROCESSED_BY_TAGGER_LABEL
-
-    :return: False if the picture is already tagged with IMAGE_PROCESSED_BY_TAGGER_LABEL, True otherwise
-    """
-    current_label_ids = _get_label_ids_for_picture(connection, picture_id)
-
-    # Skip pictures already processed by this script
-    if processed_by_tagger_label.id in current_label_ids:
-        log.debug(f"Skipping image {picture_id} (already tagged)")
-        return False
-
-    # Find all labels that need to be applied to the picture
-    missing_labels = []
-    for label in expected_labels:
-        if label.id not in current_label_ids:
-            missing_labels.append(label)
-
-    if not missing_labels:
-        log.debug(f"Image {picture_id} has no missing labels")
-        return True
-
-    for label in missing_labels:
-        _add_label_to_picture(connection, picture_id, label)
-
-    return True
-
-
-def _label_pictures_for_user(
-    connection: Connection,
-    twitter_user: str,
-    available_labels: List[Label],
-    required_labels_for_user: List[str],
-    processed_by_tagger_label: Label,
-):
-    """
-    Assign all required labels to the pictures of the specified Twitter user.
-
-    :param connection: initialized MySQLdb connection to database
-    :param twitter_user: Twitter user to search for
-    :param available_labels: list of Label tuples available in the database
-    :param required_labels_for_user: list of Label tuples that should be assigned to all pictures
-    :param processed_by_tagger_label: Label tuple representing IMAGE_PROCESSED_BY_TAGGER_LABEL
-    """
-    log.debug(f"Processing twitter user {twitter_user}")
-
-    # Get the IDs of the labels that should be applied to the pictures
-    expected_labels = []
-    for label in available_labels:
-        if label.slug in required_labels_for_user:
-            expected_labels.append(label)
-            required_labels_for_user.remove(label.slug)  # This is useful for logging in case of errors
-
-    # Throw an error if one or more required label IDs do not exist in the database
-    if required_labels_for_user:
-        log.error(
-            f"One or more required labels for user {twitter_user} are missing, cannot continue. "
-            f"Please assign the following labels to at least one picture: {', '.join(required_labels_for_user)}"
-        )
-        return
-    else:
-        log.debug(
-            f"Found required labels {', '.join([f'{label.slug} (id={label.id})' for label in expected_labels])} "
-            f"for user {twitter_user}"
-        )
-
-    picture_ids = _get_picture_ids_for_user(connection, twitter_user)
-    log.debug(f"Found {len(picture_ids)} pictures indexed for user {twitter_user}")
-
-    # Scan all pictures and check their labels
-    updated_pictures_count = 0
-    for picture in picture_ids:
-        if _label_picture(connection, picture, expected_labels, processed_by_tagger_label):
-            _mark_picture_as_processed(connection, picture, processed_by_tagger_label)
-            updated_pictures_count += 1
-
-    if updated_pictures_count:
-        log.info(f"Updated {updated_pictures_count} of {len(picture_ids)} pictures for user {twitter_user}")
-    else:
-        log.debug(f"Updated {updated_pictures_count} of {len(picture_ids)} pictures for user {twitter_user}")
-
-
 def _load_tagmap_file(filepath: str) -> Dict[str, List[str]]:
     """
-    Load the tag map file or create a new one if it doesn't exist.
+    Load the tag map file or create a new one if it doesn't exist. The file is parsed again only if it changed since the
+    last time it was loaded.
 
     :param filepath: path to tag map file
 
     :return: contents of tag map file
     """
     try:
-        with open(filepath) as fd:
-            return yaml.safe_load(fd)
+        return load_yaml_file(filepath)
     except FileNotFoundError:
         log.info(f"Creating default tag map file in {filepath}")
         _create_tagmap_file(filepath)
@@ -422,12 +390,19 @@ def _load_tagmap_file(filepath: str) -> Dict[str, List[str]]:
         raise
 
 
-def _mark_picture_as_processed(connection: Connection, picture_id: str, processed_by_tagger_label: Label):
+def _remove_media_from_album(connection: Connection, album_uid: str, picture_uids: Set[str]):
     """
-    Assign the IMAGE_PROCESSED_BY_TAGGER_LABEL label to the specified picture
+    Remove the association between the specified media and album.
 
     :param connection: initialized MySQLdb connection to database
-    :param picture_id: PhotoPrism ID of the picture to process
-    :param processed_by_tagger_label: Label tuple representing IMAGE_PROCESSED_BY_TAGGER_LABEL
+    :param album_uid: UID of the album
+    :param picture_uids: set of UIDs of the pictures to remove
     """
-    _add_label_to_picture(connection, picture_id, processed_by_tagger_label)
+    if not picture_uids:
+        log.debug("No images to remove from album %s, aborting query", album_uid)
+        return
+
+    log.debug("Removing %s media items from album %s", len(picture_uids), album_uid)
+    placeholders = ", ".join(["%s"] * len(picture_uids))
+    query = f"DELETE FROM photos_albums WHERE album_uid = %s AND photo_uid IN ({placeholders})"
+    mysql.execute_query(connection, query, [album_uid, *picture_uids])
@@ -1,11 +1,36 @@
+import json
 import logging
+import os
+import time
 from configparser import ConfigParser
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional
 
 import tweepy  # type: ignore
 import yaml
+from tenacity import (
+    RetryCallState,
+    before_sleep_log,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+)
 
 from modules.config import get_blacklist_file
+from modules.utils import load_yaml_file, write_file_atomically
+
+# Maximum number of tweets that can be looked up with a single API request
+LOOKUP_BATCH_SIZE = 100
+
+# Longest wait (in seconds) for the API rate limit window to be reset before looking tweets up again
+MAX_RATE_LIMIT_WAIT = 15 * 60
+
+# Size requested for pictures, the default size of the media URL is a lower quality version
+PHOTO_SIZE = "large"
+
+# Tweets loaded by ID are cached on disk for this long (in seconds), so that loading the same status again doesn't
+# use an API request
+TWEET_CACHE_DIRECTORY = os.path.join(".cache", "tweets")
+TWEET_CACHE_MAX_AGE = 24 * 60 * 60
 
 log = logging.getLogger()
 
@@ -22,13 +47,22 @@ def _create_blacklist_file(filepath: str, blacklist: Optional[List[str]] = None)
     file_content = yaml.dump({"blacklisted_ids": blacklist})
     log.debug(f"Writing {filepath} with {len(blacklist)} blacklisted tweet IDs")
     try:
-        with open(filepath, "w") as fd:
-            fd.write(f"{comment}\n{file_content}")
+        write_file_atomically(filepath, f"{comment}\n{file_content}")
     except IOError as e:
         log.error(f"Failed to write blacklist file: {e}")
         raise
 
 
+def _get_tweet_cache_filepath(tweet_id: str) -> str:
+    """
+    Build the path of the file caching the specified tweet.
+
+    :param tweet_id: ID of the twitter status
+    :return: path to cache file
+    """
+    return os.path.join(TWEET_CACHE_DIRECTORY, f"{tweet_id}.json")
+
+
 def _handle_media_type_video(media: Dict[str, Any]) -> str:
     """
     Media type 'video' requires us to select the URL with the highest bitrate.
@@ -36,45 +70,17 @@ def _handle_media_type_video(media: Dict[str, Any]) -> str:
     :param media: tweepy.models.Status.extended_entities dictionary
     :return: URL to video variant with the highest bitrate
     """
-    variants_list = media["video_info"]["variants"]
-    highest_quality_variant = variants_list.pop()
-    log.debug(
-        f"Considering video variant {highest_quality_variant['content_type']} "
-        f"{highest_quality_variant.get('bitrate', '(no bitrate)')}: {highest_quality_variant['url']}"
-    )
+    # Video formats that don't specify a bitrate (mpeg) are only used if no other format is available
+    highest_quality_variant = max(media["video_info"]["variants"], key=lambda variant: variant.get("bitrate") or -1)
 
-    # Discard video formats that don't specify a bitrate (mpeg) if any other format that does is available.
-    while variants_list and not highest_quality_variant.get("bitrate"):
-        log.debug(
-            f"Discarding video variant {highest_quality_variant['content_type']} (no bitrate specified): "
-            f"{highest_quality_variant['url']}"
-        )
-        highest_quality_variant = variants_list.pop()
-        log.debug(
-            f"Considering video variant {highest_quality_variant['content_type']} "
-            f"{highest_quality_variant.get('bitrate', '(no bitrate)')}: {highest_quality_variant['url']}"
-        )
-
-    # Pick the variant with the highest bitrate
-    for variant in variants_list:
-        if variant.get("bitrate") and variant["bitrate"] > highest_quality_variant["bitrate"]:
+    if log.isEnabledFor(logging.DEBUG):
+        if highest_quality_variant.get("bitrate"):
             log.debug(
-                f"Promoting video variant {variant['content_type']} {variant['bitrate']} (better quality): "
-                f"{variant['url']}"
+                f"Using video variant {highest_quality_variant['url']} "
+                f"with bitrate={highest_quality_variant['bitrate']}"
             )
-            highest_quality_variant = variant
         else:
-            log.debug(
-                f"Discarding video variant {variant['content_type']} "
-                f"{variant.get('bitrate', '(no bitrate)')} (inferior quality): {variant['url']}"
-            )
-
-    if highest_quality_variant.get("bitrate"):
-        log.debug(
-            f"Using video variant {highest_quality_variant['url']} with bitrate={highest_quality_variant['bitrate']}"
-        )
-    else:
-        log.debug(f"Using video variant {highest_quality_variant['url']} (no bitrate specified)")
+            log.debug(f"Using video variant {highest_quality_variant['url']} (no bitrate specified)")
 
     return highest_quality_variant["url"]
 
@@ -91,21 +97,33 @@ def _handle_media_type_animated_gif(media: Dict[str, Any]) -> str:
     return variant["url"]
 
 
-def _load_blacklisted_tweets_file(filepath: str) -> List[str]:
+def _handle_media_type_photo(media: Dict[str, Any]) -> str:
+    """
+    Media type 'photo' handling. The picture is requested in PHOTO_SIZE size.
+
+    :param media: tweepy.models.Status.extended_entities dictionary
+    :return: URL to picture, ie. 'https://pbs.twimg.com/media/FZrP4mMXEAAVxhv.jpg?format=jpg&name=large'
+    """
+    url = media["media_url_https"]
+    extension = url.rpartition(".")[2]
+    return f"{url}?format={extension}&name={PHOTO_SIZE}"
+
+
+def _load_blacklisted_tweets_file(filepath: str) -> FrozenSet[str]:
     """
-    Load the list of blacklisted tweets IDs.
+    Load the set of blacklisted tweets IDs. The file is parsed again only if it changed since the last time it was
+    loaded.
 
     :param filepath: path to blacklist file
-    :return: list of blacklisted tweet IDs
+    :return: set of blacklisted tweet IDs
     """
     try:
-        with open(filepath) as fd:
-            file_content = yaml.safe_load(fd)
-            return file_content["blacklisted_ids"]
+        file_content = load_yaml_file(filepath)
+        return frozenset(file_content["blacklisted_ids"])
     except FileNotFoundError:
         log.info(f"Creating default blacklist file in {filepath}")
         _create_blacklist_file(filepath)
-        return []
+        return frozenset()
     except IOError as e:
         log.error(f"Failed to load blacklist file {filepath}: {e}")
         raise
@@ -118,12 +136,119 @@ def _load_blacklisted_tweets_file(filepath: str) -> List[str]:
         raise
 
 
-def get_all_media_from_tweet(tweet: tweepy.models.Status) -> List[Tuple[str, bool]]:
+def _load_cached_tweet(api: tweepy.API, tweet_id: str) -> Optional[tweepy.models.Status]:
+    """
+    Load a tweet from the disk cache if it has been cached less than TWEET_CACHE_MAX_AGE seconds ago.
+
+    :param api: tweepy API object
+    :param tweet_id: ID of the twitter status to load
+    :return: tweepy.models.Status object, None if the tweet isn't cached or the cache has expired
+    """
+    # The ID is used in a file path, only accept actual status IDs
+    if not tweet_id.isdigit():
+        return None
+
+    cache_filepath = _get_tweet_cache_filepath(tweet_id)
+    try:
+        if time.time() - os.stat(cache_filepath).st_mtime > TWEET_CACHE_MAX_AGE:
+            log.debug(f"Cached tweet {cache_filepath} has expired")
+            return None
+        with open(cache_filepath) as fd:
+            tweet_json = json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (IOError, ValueError) as e:
+        log.warning(f"Ignoring unreadable cached tweet {cache_filepath}: {e}")
+        return None
+
+    return tweepy.models.Status.parse(api, tweet_json)
+
+
+def _wait_for_rate_limit_reset(retry_state: RetryCallState) -> float:
+    """
+    Compute how long to wait for the API rate limit window to be reset, from the 'x-rate-limit-reset' header (epoch
+    time) of the rate limited response.
+
+    :param retry_state: tenacity state of the current call
+    :return: seconds to wait
+    """
+    outcome = retry_state.outcome
+    exception = outcome.exception() if outcome is not None else None
+    reset_time = ""
+    if isinstance(exception, tweepy.TooManyRequests):
+        reset_time = exception.response.headers.get("x-rate-limit-reset", "")
+    if not reset_time.isdigit():
+        return MAX_RATE_LIMIT_WAIT
+    return min(max(int(reset_time) - time.time() + 1, 0), MAX_RATE_LIMIT_WAIT)
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=_wait_for_rate_limit_reset,
+    retry=retry_if_exception_type(tweepy.TooManyRequests),
+    reraise=True,
+    before_sleep=before_sleep_log(log, logging.WARNING),
+)
+def _lookup_statuses(api: tweepy.API, tweet_ids: List[str]) -> List[tweepy.models.Status]:
+    """
+    Look tweets up with a single API request. If the API rate limit is reached, wait for its window to be reset and try
+    again: only the calling thread is blocked, the media of the tweets already loaded keep downloading meanwhile.
+
+    :param api: tweepy API object
+    :param tweet_ids: IDs of the twitter statuses to look up, at most LOOKUP_BATCH_SIZE
+    :return: list of tweepy.models.Status objects, tweets that couldn't be found are not included
+    """
+    # https://docs.tweepy.org/en/latest/api.html#tweepy.API.lookup_statuses
+    return api.lookup_statuses(id=tweet_ids, tweet_mode="extended")
+
+
+def _prune_tweet_cache():
+    """
+    Remove the tweets cached more than TWEET_CACHE_MAX_AGE seconds ago from the disk cache, so that it doesn't grow
+    without bound. Failures are logged but not raised, the cache is only an optimization.
+    """
+    expiry_time = time.time() - TWEET_CACHE_MAX_AGE
+    removed_count = 0
+    try:
+        with os.scandir(TWEET_CACHE_DIRECTORY) as dir_iterator:
+            for entry in dir_iterator:
+                # A file removed by another run in the meantime is already pruned, other failures only skip this file
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < expiry_time:
+                        os.remove(entry.path)
+                        removed_count += 1
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    log.warning(f"Failed to remove cached tweet {entry.path}: {e}")
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        log.warning(f"Failed to prune tweet cache {TWEET_CACHE_DIRECTORY}: {e}")
+    log.debug(f"Removed {removed_count} expired tweets from cache")
+
+
+def _save_cached_tweet(tweet: tweepy.models.Status):
+    """
+    Save the JSON representation of a tweet in the disk cache. Failures are logged but not raised, the cache is only an
+    optimization.
+
+    :param tweet: tweepy.models.Status object
+    """
+    cache_filepath = _get_tweet_cache_filepath(tweet.id_str)
+    try:
+        os.makedirs(TWEET_CACHE_DIRECTORY, exist_ok=True)
+        write_file_atomically(cache_filepath, json.dumps(tweet._json))
+    except IOError as e:
+        log.warning(f"Failed to cache tweet {tweet.id_str}: {e}")
+
+
+def get_all_media_from_tweet(tweet: tweepy.models.Status) -> List[str]:
     """
     Given a tweet, return all media found in it.
 
     :param tweet: tweepy.models.Status object
-    :return: dict of media URLs as key and size information for pictures as value
+    :return: list of media URLs, ready to be downloaded
     """
     source_tweet = tweet.id_str
     source_user = tweet.user.screen_name
@@ -144,11 +269,11 @@ def get_all_media_from_tweet(tweet: tweepy.models.Status) -> List[Tuple[str, boo
     media_urls = []
     for media in tweet.extended_entities["media"]:
         if media["type"] == "animated_gif":
-            media_urls.append((_handle_media_type_animated_gif(media), False))
+            media_urls.append(_handle_media_type_animated_gif(media))
         elif media["type"] == "video":
-            media_urls.append((_handle_media_type_video(media), False))
+            media_urls.append(_handle_media_type_video(media))
         elif media["type"] == "photo":
-            media_urls.append((media["media_url_https"], True))
+            media_urls.append(_handle_media_type_photo(media))
         else:
             log.error(f"Unrecognized media type '{media['type']}' from tweet ID {source_tweet}")
             continue
@@ -171,12 +296,8 @@ def filter_blacklisted_tweets(
     blacklisted_tweets = _load_blacklisted_tweets_file(blacklist_file)
     log.info(f"Found {len(blacklisted_tweets)} blacklisted tweets")
 
-    filtered_list = []
-    for tweet in tweets_list:
-        if tweet.id_str in blacklisted_tweets:
-            log.debug(f"Removing blacklisted tweet ID {tweet.id_str}")
-        else:
-            filtered_list.append(tweet)
+    filtered_list = [tweet for tweet in tweets_list if tweet.id_str not in blacklisted_tweets]
+    log.debug(f"Removed {len(tweets_list) - len(filtered_list)} blacklisted tweets")
     return filtered_list
 
 
@@ -194,18 +315,41 @@ def load_liked_tweets(api: tweepy.API, count: int = 200) -> tweepy.models.Result
     return tweets_list
 
 
-def load_single_tweet(api: tweepy.API, tweet_id: str) -> tweepy.models.ResultSet:
+def load_tweets_in_batches(api: tweepy.API, tweet_ids: List[str]) -> Iterator[List[tweepy.models.Status]]:
     """
-    Load a single tweet given its ID and return a list containing the one tweet.
+    Load tweets given their IDs, and yield them as soon as they are available so that the caller can process them
+    while the next ones are loaded. Tweets loaded less than TWEET_CACHE_MAX_AGE seconds ago are read from the disk
+    cache and yielded first, the others are looked up and yielded LOOKUP_BATCH_SIZE at a time.
 
     :param api: tweepy API object
-    :param tweet_id: ID of the twitter status to download
-    :return: list of tweepy.models.Status objects (limited to the specified tweet)
+    :param tweet_ids: IDs of the twitter statuses to download
+    :return: iterator over lists of tweepy.models.Status objects, tweets that couldn't be found are not included
     """
-    # https://docs.tweepy.org/en/latest/api.html#tweepy.API.lookup_statuses
-    tweets_list = api.lookup_statuses(id=[tweet_id], tweet_mode="extended")
-    log.info(f"Loaded {len(tweets_list)} tweets")
-    return tweets_list
+    cached_tweets = []
+    ids_to_lookup = []
+    for tweet_id in tweet_ids:
+        cached_tweet = _load_cached_tweet(api, tweet_id)
+        if cached_tweet is not None:
+            cached_tweets.append(cached_tweet)
+        else:
+            ids_to_lookup.append(tweet_id)
+    log.debug(f"Loaded {len(cached_tweets)} tweets from cache")
+    if cached_tweets:
+        yield cached_tweets
+
+    # The cache only grows when tweets are looked up, the expired ones are removed at the same time
+    if ids_to_lookup:
+        _prune_tweet_cache()
+
+    loaded_tweets_count = len(cached_tweets)
+    for start in range(0, len(ids_to_lookup), LOOKUP_BATCH_SIZE):
+        looked_up_tweets = _lookup_statuses(api, ids_to_lookup[start : start + LOOKUP_BATCH_SIZE])
+        for tweet in looked_up_tweets:
+            _save_cached_tweet(tweet)
+        loaded_tweets_count += len(looked_up_tweets)
+        yield looked_up_tweets
+
+    log.info(f"Loaded {loaded_tweets_count} tweets")
 
 
 def update_tweets_blacklist(
@@ -219,14 +363,12 @@ def update_tweets_blacklist(
     :param tweets_list: list of all available tweets
     """
     # Load all Tweet IDs
-    tweet_ids_set: Set[str] = set()
-    for tweet in tweets_list:
-        tweet_ids_set.add(tweet.id_str)
+    tweet_ids_set = {tweet.id_str for tweet in tweets_list}
 
     # Get the Tweet IDs from blacklist and filter out the ones that don't appear in the list returned by Twitter
     blacklist_file = get_blacklist_file(configuration)
     previous_blacklisted_tweets = _load_blacklisted_tweets_file(blacklist_file)
-    valid_blacklisted_tweets = [t for t in previous_blacklisted_tweets if t in tweet_ids_set]
+    valid_blacklisted_tweets = previous_blacklisted_tweets & tweet_ids_set
 
     # Return if there are no changes to the blacklist
     if not new_blacklisted_tweets and len(valid_blacklisted_tweets) == len(previous_blacklisted_tweets):
@@ -238,8 +380,9 @@ def update_tweets_blacklist(
         "expired Tweet IDs from blacklist"
     )
 
-    # Merge the blacklists and write to file
-    full_blacklist = list(set(valid_blacklisted_tweets + new_blacklisted_tweets))
+    # Merge the blacklists and write to file. The file is small: it's always rewritten as a whole, so that it's never
+    # left partially written.
+    full_blacklist = sorted(valid_blacklisted_tweets.union(new_blacklisted_tweets))
     _create_blacklist_file(blacklist_file, full_blacklist)
 
     blacklisted_new = len(new_blacklisted_tweets)
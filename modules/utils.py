@@ -1,10 +1,23 @@
+import copy
 import logging
+import os
 import re
-from typing import Dict
+from contextlib import suppress
+from functools import lru_cache
+from typing import Any, Dict
 
-# Expected filename format for downloaded media
-FILENAME_REGEX = "(?P<account>\w+)_(?P<date>\d{4}-\d{2}-\d{2})_(?P<id>\d*)_(?P<media_count>\d).(?P<extension>\w+)"
-COMPILED_FILENAME_REGEX = re.compile(FILENAME_REGEX)
+import yaml
+
+# Use the LibYAML bindings to parse YAML files if PyYAML was built with them
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader  # type: ignore
+
+# Expected filename format for downloaded media. Twitter usernames are ASCII only and may contain underscores, the
+# account group is non-greedy so that the date is looked for right after the first underscore.
+FILENAME_REGEX = r"(?P<account>\w+?)_(?P<date>\d{4}-\d{2}-\d{2})_(?P<id>\d+)_(?P<media_count>\d)\.(?P<extension>\w+)"
+COMPILED_FILENAME_REGEX = re.compile(FILENAME_REGEX, re.ASCII)
 
 log = logging.getLogger()
 
@@ -23,8 +36,71 @@ def groupdict_from_filename(filename: str) -> Dict[str, str]:
     :return: account name
     :raise ValueError: if the filename failed to match the regular expression
     """
-    matched = COMPILED_FILENAME_REGEX.match(filename)
+    matched = COMPILED_FILENAME_REGEX.fullmatch(filename)
     if not matched:
         raise ValueError(f"Failed to parse file {filename}")
 
     return matched.groupdict()
+
+
+@lru_cache(maxsize=512)
+def isdir_cached(path: str) -> bool:
+    """
+    Cached version of os.path.isdir(). The same directories are checked for every media file, and they are not expected
+    to change while downloading. Call isdir_cached.cache_clear() after creating or removing directories.
+
+    :param path: path to check
+    :return: True if path is an existing directory, False otherwise
+    """
+    return os.path.isdir(path)
+
+
+def load_yaml_file(filepath: str) -> Any:
+    """
+    Parse a YAML file. The parsed content is cached until the file is modified, and a copy of it is returned so that
+    callers can safely modify it.
+
+    :param filepath: path to YAML file
+    :return: parsed content of the file
+    :raise FileNotFoundError: if the file doesn't exist
+    :raise IOError: on file read failure
+    :raise yaml.YAMLError: on file parse failure
+    """
+    file_stat = os.stat(filepath)
+    return copy.deepcopy(_parse_yaml_file(filepath, file_stat.st_mtime_ns, file_stat.st_size))
+
+
+def write_file_atomically(filepath: str, content: str):
+    """
+    Write a text file through a temporary file that replaces the destination once complete, so that the destination
+    is never left partially written.
+
+    :param filepath: path to file to write
+    :param content: text to write to the file
+    :raise IOError: on file write failure
+    """
+    tmp_filepath = f"{filepath}.tmp"
+    try:
+        with open(tmp_filepath, "w") as fd:
+            fd.write(content)
+        os.replace(tmp_filepath, filepath)
+    except IOError:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_filepath)
+        raise
+
+
+@lru_cache(maxsize=8)
+def _parse_yaml_file(filepath: str, mtime: int, size: int) -> Any:
+    """
+    Parse a YAML file. Modification time and size are only used as cache keys, so that the cached value is discarded
+    when the file changes.
+
+    :param filepath: path to YAML file
+    :param mtime: modification time of the file in nanoseconds
+    :param size: size of the file in bytes
+    :return: parsed content of the file
+    """
+    log.debug(f"Parsing YAML file {filepath}")
+    with open(filepath) as fd:
+        return yaml.load(fd, Loader=YamlSafeLoader)
@@ -1,39 +1,78 @@
 #! /usr/bin/env python3
 """
-Connect to twitter, download media from a specified tweet.
+Connect to twitter, download media from the specified tweets.
 """
 import argparse
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Set
 
-from modules import auth, config, media, twitter
+from modules import config
 
 # Logging setup
 log = logging.getLogger()
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(module)s:%(lineno)d %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
 
+# Command line parser, built once when the module is imported
+_PARSER = argparse.ArgumentParser(description="Download media of the specified Twitter statuses")
+_PARSER.add_argument("--debug", action="store_true", help="set logging to DEBUG level")
+_PARSER.add_argument("--force", action="store_true", help="do not check if media files are already on disk")
+_PARSER.add_argument("status_ids", metavar="TWITTER_ID", type=str, nargs="+", help="Twitter status ID")
+
+
 def parse_args():
-    parser = argparse.ArgumentParser(description="Download media of the specified Twitter status")
-    parser.add_argument("--debug", action="store_true", help="set logging to DEBUG level")
-    parser.add_argument("--force", action="store_true", help="do not check if media files are already on disk")
-    parser.add_argument("status_id", metavar="TWITTER_ID", type=str, help="Twitter status ID")
-    return parser.parse_args()
+    return _PARSER.parse_args()
 
 
 def main(args: argparse.Namespace):
-    # Load configuration and connect to the Twitter API
+    # Imported here so that parsing the command line (ie. --help) doesn't pay for loading the heavier dependencies
+    from modules import auth, media, twitter
+
+    # Load configuration
     configuration = config.get_configuration()
+    context = config.DownloadContext.from_config(configuration)
+    status_ids = list(dict.fromkeys(args.status_ids))
+
+    # Tweets with media on disk are skipped before they are loaded, their media would not be downloaded again anyway
+    if not args.force:
+        downloaded_ids = media.find_tweets_on_disk(context.download_directory, status_ids)
+        for status_id in status_ids:
+            if status_id in downloaded_ids:
+                log.info("Media of https://twitter.com/i/web/status/%s already on disk, skipping", status_id)
+        status_ids = [status_id for status_id in status_ids if status_id not in downloaded_ids]
+        if not status_ids:
+            return
+
+    # Connect to the Twitter API
     twitter_api = auth.get_authenticated_api(configuration)
-    tweets_list = twitter.load_single_tweet(twitter_api, args.status_id)
 
-    if not tweets_list:
-        log.error(f"Unable to find Twitter status https://twitter.com/i/web/status/{args.status_id}")
+    # The media files of a single tweet are downloaded concurrently, otherwise the tweets are processed concurrently
+    media_workers = context.download_workers if len(status_ids) == 1 else 1
+
+    def process_tweet(tweet):
+        log.debug("Processing tweet https://twitter.com/i/web/status/%s", tweet.id_str)
+        return media.download_media(tweet, context, args.force, max_workers=media_workers)
+
+    # Tweets are processed as soon as they are loaded: the cached tweets and the first batches are downloaded while the
+    # next batches are looked up
+    media.set_max_connections(context.download_workers)
+    found_ids: Set[str] = set()
+    with ThreadPoolExecutor(max_workers=context.download_workers) as executor:
+        futures: List[Future] = []
+        for tweets_batch in twitter.load_tweets_in_batches(twitter_api, status_ids):
+            found_ids.update(tweet.id_str for tweet in tweets_batch)
+            futures.extend(executor.submit(process_tweet, tweet) for tweet in tweets_batch)
+        results = [future.result() for future in futures]
+
+    for status_id in status_ids:
+        if status_id not in found_ids:
+            log.error("Unable to find Twitter status https://twitter.com/i/web/status/%s", status_id)
+    if not results:
         return
 
-    tweet = tweets_list[0]
-    log.debug(f"Processing tweet https://twitter.com/i/web/status/{tweet.id_str}")
-    downloaded_media_count, media_found = media.download_media(tweet, configuration, args.force)
-    log.info(f"Downloaded {downloaded_media_count} media files.")
+    downloaded_media_count = sum(tweet_media_count for tweet_media_count, _ in results)
+    log.info("Downloaded %d media files from %d tweets.", downloaded_media_count, len(results))
 
 
 if __name__ == "__main__":
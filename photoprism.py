@@ -6,38 +6,57 @@ Connect to the PhotoPrism database and DO THINGS!!!!
 """
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
 
-from modules import config, mysql, photoprism
+from modules import config
 
 # Logging setup
 log = logging.getLogger()
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(module)s:%(lineno)d %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
 
+# Command line parser, built once when the module is imported
+_PARSER = argparse.ArgumentParser(description="Manage media indexed by PhotoPrism.")
+_PARSER.add_argument("--debug", action="store_true", help="set logging to DEBUG level")
+_PARSER.add_argument("--tag", action="store_true", help="create and manage media labels")
+_PARSER.add_argument("--update-recent", action="store_true", help="update the recent media album")
+
+
 def parse_args():
-    parser = argparse.ArgumentParser(description="Manage media indexed by PhotoPrism.")
-    parser.add_argument("--debug", action="store_true", help="set logging to DEBUG level")
-    parser.add_argument("--tag", action="store_true", help="create and manage media labels")
-    parser.add_argument("--update-recent", action="store_true", help="update the recent media album")
-    return parser.parse_args()
+    return _PARSER.parse_args()
 
 
 def main(args: argparse.Namespace):
+    # Imported here so that parsing the command line (ie. --help) doesn't pay for loading the heavier dependencies
+    from modules import mysql, photoprism
+
     log.info("Starting PhotoPrism utility")
     configuration = config.get_configuration()
-    db_connection = mysql.connect(configuration)
 
     if not (args.tag or args.update_recent):
         log.warning("No operation selected, exiting without taking any action")
         return
 
+    operations = []
     # Update media labels
     if args.tag:
-        photoprism.label_known_artists(db_connection, configuration)
-
+        operations.append(photoprism.label_known_artists)
     # Update Recent media album
     if args.update_recent:
-        photoprism.update_recent_pictures_album(db_connection, configuration)
+        operations.append(photoprism.update_recent_pictures_album)
+
+    # The operations work on different tables, they run concurrently with a database connection each. All connections
+    # are opened before any operation starts, so that a failing connection doesn't leave an operation half done
+    with ExitStack() as stack:
+        connections = [stack.enter_context(closing(mysql.connect(configuration))) for _ in operations]
+        with ThreadPoolExecutor(max_workers=len(operations)) as executor:
+            futures = [
+                executor.submit(operation, connection, configuration)
+                for operation, connection in zip(operations, connections)
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":